@@ -1,5 +1,11 @@
 from sympy import isprime
 
+try:
+    # GMP integers square much faster than Python's once exponents get large
+    from gmpy2 import mpz
+except ImportError:
+    mpz = int
+
 def find_next_mersenne_prime(earlier_prime):
     p = earlier_prime + 1
     while not lucas_lehmer_test(p): p += 1
@@ -8,8 +14,8 @@ def find_next_mersenne_prime(earlier_prime):
 def lucas_lehmer_test(n):
     if n == 2: return True
     if not isprime(n): return False
-    m = 2 ** n - 1
-    s = 4
+    m = (mpz(1) << n) - 1
+    s = mpz(4)
     for i in range(2, n):
         square = s * s
         s = (square & m) + (square >> n)
@@ -1,4 +1,15 @@
 import functools
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+
+# orjson only handles ints in [-2^63, 2^64); a run of 19+ digits may fall outside that
+LONG_INT = re.compile(rb"\d{19}")
 
 def only_if_awake(state):
     '''
@@ -14,3 +25,58 @@ def only_if_awake(state):
     			return "Asleep"
     	return wrapped
     return callable
+
+class BoundedSet:
+    '''
+    A set that holds at most `maxlen` items. Once full, adding a new item
+    forgets the one that was added least recently.
+    '''
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.items = OrderedDict()
+
+    def add(self, item):
+        self.items[item] = None
+        self.items.move_to_end(item)
+        if len(self.items) > self.maxlen:
+            self.items.popitem(last=False)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+def exit_with_parent(poll_interval=1.0):
+    '''
+    Initializer for worker processes. Exits the worker as soon as the process
+    that started it is gone (however it died), rather than leaving it orphaned
+    and still crunching.
+    '''
+    parent = os.getppid()
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(poll_interval)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+def encode_json(obj, option=None) -> bytes:
+    '''
+    Serializes with orjson, falling back to the stdlib for anything orjson
+    refuses (e.g. ints wider than 64 bits, like a Mersenne prime).
+    '''
+    try:
+        return orjson.dumps(obj, option=option)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj).encode()
+
+def decode_json(data: bytes):
+    '''
+    Parses with orjson, unless the body holds a number orjson would silently
+    turn into a float; the stdlib keeps those as exact ints.
+    '''
+    if LONG_INT.search(data):
+        return json.loads(data)
+    return orjson.loads(data)
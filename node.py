@@ -1,6 +1,8 @@
 from flask import Flask, request, Response
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from flask_cors import CORS
-from threading import Timer
+from collections import deque
+from threading import Lock, Timer
 from waitress import serve
 from typing import Union
 import logging
@@ -8,15 +10,25 @@ import os
 import time
 import traceback
 import sys
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import random
+import itertools
 from backendy_stuff.primes import find_next_mersenne_prime
-from backendy_stuff.utils import only_if_awake
+from backendy_stuff.utils import BoundedSet, decode_json, encode_json, exit_with_parent, only_if_awake
 
 app = Flask(__name__, static_url_path="", static_folder="./frontend")
 CORS(app)
 
+
+class OrjsonResponse(Response):
+    '''
+    Response for a body that's already been serialized to JSON (see `encode_json`).
+    '''
+    default_mimetype = "application/json"
+
+
 if len(sys.argv) < 2:
     raise Exception("Must pass in port number")
 MY_PORT = int(sys.argv[1])
@@ -27,8 +39,37 @@ if MY_PORT < 1024:
 names = open("names.txt", "r").read().split("\n")
 MY_NAME = random.choice(names)
 
-# Message log
-LOGS = []
+# Message log (we only ever show the last few, so old entries fall off the end)
+MAX_LOGS = 1024
+LOGS = deque(maxlen=MAX_LOGS)
+# The last few log entries, already serialized for /message_log (see `refresh_message_log`)
+LAST_LOG_BYTES = b"[]"
+
+# Outgoing messages waiting to be flushed (key: port number, value: list of messages)
+OUTBOX = {}
+OUTBOX_LOCK = Lock()
+# Most messages we'll pack into a single POST to one peer
+MAX_BATCH_SIZE = 64
+
+# Threads that post batches to peers, so sends to different peers run in parallel
+SEND_POOL = ThreadPoolExecutor(max_workers=16)
+# Shared HTTP session, so sends to a peer reuse a kept-alive connection
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=0))
+# Seconds to wait on a peer before giving up on a send
+SEND_TIMEOUT = 2.0
+# (key: port number, value: URL we post that peer's batches to), filled in as we go
+URL_CACHE = {}
+
+# Fields we stamp on every message we forward, and on every message we originate
+FORWARDED_FIELDS = {"msg_forwarder": MY_PORT}
+ORIGINATED_FIELDS = {"msg_forwarder": MY_PORT, "msg_originator": MY_PORT}
+
+# Mersenne prime search runs in its own process so it doesn't hold up the timer threads
+# (started at boot, see the bottom of this file)
+PRIME_SEARCH_POOL = None
+# The search currently in flight, if any
+PRIME_SEARCH = None
 
 #################################################################
 #################################################################
@@ -42,8 +83,21 @@ PONG = "PONG"
 PRIME = "PRIME"
 MESSAGE_TYPES = set([PING, PONG, PRIME])
 
-# List of all messages we've seen before (so as not to re-transmit duplicates)
-RECEIVED_MESSAGES = set()
+# Number of randomly chosen peers we forward a PRIME on to
+INFECTION_FACTOR = 2
+
+# Recent messages we've seen before (so as not to re-transmit duplicates)
+MAX_RECEIVED_MESSAGES = 10000
+RECEIVED_MESSAGES = BoundedSet(maxlen=MAX_RECEIVED_MESSAGES)
+
+# Source of message ids; next() on it is atomic, so concurrent sends never share an id
+MSG_IDS = itertools.count()
+
+# Guards adding peers to and removing peers from STATE["peers"]
+PEERS_LOCK = Lock()
+
+# Guards the compare-and-swap on STATE["biggest_prime"] and STATE["biggest_prime_sender"]
+STATE_LOCK = Lock()
 
 # Global state object for reading and altering state. You should read and write to this.
 STATE = {
@@ -51,7 +105,7 @@ STATE = {
     "port": MY_PORT,
     # (key: port number, value: timestamp when we last heard from them)
     "peers": {},
-    # Biggest Mersenne prime we've seen so far (starts at 2)
+    # Biggest Mersenne prime we've seen so far, stored as its exponent p (i.e. the prime is 2^p - 1; starts at 2)
     "biggest_prime": 2,
     # Sender of the current biggest prime (starts as self)
     "biggest_prime_sender": MY_PORT,
@@ -76,7 +130,7 @@ def respond(
         msg_type (str):
                     "PING", "PONG", or "PRIME" (you can use the constants PING/PONG/PRIME)
         msg_id (int):
-                    The auto-incrementing message counter for each node
+                    The auto-incrementing message counter of the node that created the message
             msg_forwarder (int):
                     The port of the immediate node that sent you this message
             msg_originator (int):
@@ -84,7 +138,7 @@ def respond(
             ttl (int):
                     Time-to-live; the number of hops remaining in the lifetime of this message until it should be dropped. A 0 TTL message should not be forwarded.
             data (None or int):
-                    The data in the message payload. For PINGs and PONGs, this will be None. For a PRIME message, the data field will contain the prime number.
+                    The data in the message payload. For PINGs and PONGs, this will be None. For a PRIME message, the data field will contain the Mersenne exponent p of the prime 2^p - 1.
 
     Returns:
         Nothing
@@ -92,13 +146,7 @@ def respond(
 
     update_last_heard_from(msg_forwarder)
 
-    msg = (msg_type, msg_id, msg_forwarder, msg_originator, ttl, data)
-
-    if msg in RECEIVED_MESSAGES:
-        return
-
-    RECEIVED_MESSAGES.add(msg)
-    
+    # Duplicates have already been filtered out by `handle_message`
     if msg_type == PING:
 
         pong = {
@@ -110,33 +158,55 @@ def respond(
 
     elif msg_type == PRIME:
 
-        if data!=None and data > STATE["biggest_prime"]:
+        update_last_heard_from(msg_originator)
+
+        with STATE_LOCK:
+            # Not news to us, so not worth passing on either
+            if data is None or data <= STATE["biggest_prime"]:
+                return
+
             STATE["biggest_prime"] = data
             STATE["biggest_prime_sender"] = msg_originator
 
-        STATE["peers"][msg_originator] = time.time()
-
         if ttl > 0:
             forward_prime_msg = {
                 "msg_type": PRIME,
                 "ttl": ttl-1,
                 "data": data,
+                "msg_id": msg_id,
                 "msg_originator": msg_originator
             }
-            for peer in [*STATE["peers"]]:
-                if peer != msg_forwarder and peer != msg_originator:
-                    send_message_to(peer=peer, message=forward_prime_msg, forwarded=True)
+            candidates = [p for p in peers_snapshot() if p != msg_forwarder and p != msg_originator]
+            peers = random.sample(candidates, min(INFECTION_FACTOR, len(candidates)))
+            broadcast(peers=peers, message=forward_prime_msg, forwarded=True)
 
     pass
 
 
+def peers_snapshot() -> tuple:
+    '''
+    Copy of the ports in our peer list. Loop over this rather than
+    STATE["peers"] itself, which other threads may be adding to or evicting
+    from while we iterate.
+    '''
+    with PEERS_LOCK:
+        return tuple(STATE["peers"])
+
+
 def update_last_heard_from(peer: int):
     '''
     Helper method to log when we last heard from a peer. We have to keep
     updating when we last heard from each peer, otherwise stale peers will
     churn out of our peer list after 10 seconds.
     '''
-    STATE["peers"][peer] = time.time()
+    peers = STATE["peers"]
+    if peer in peers:
+        # Refreshing a known peer is a single-key store, which is atomic on
+        # its own; only adding a new peer changes the dict's size
+        peers[peer] = time.time()
+    else:
+        with PEERS_LOCK:
+            peers[peer] = time.time()
 
 
 @only_if_awake(STATE)
@@ -152,29 +222,44 @@ def send_message_to(peer: int, message: dict, forwarded: bool):
         raise Exception("Must have a TTL")
     if not "msg_type" in message or message["msg_type"] not in MESSAGE_TYPES:
         raise Exception("Must have a valid msg_type")
-    if forwarded and "msg_originator" not in message:
+    if forwarded and ("msg_originator" not in message or "msg_id" not in message):
         raise Exception(
-            "Must have msg_originator in message if message was forwarded")
+            "Must have msg_originator and msg_id in message if message was forwarded")
+
+    # Build a fresh dict rather than updating in place: the same message may be
+    # going out to several peers at once (see `broadcast`).
+    # If message originates from us, include that in the message. Forwarded
+    # messages keep their original id, so (msg_id, msg_originator) names a
+    # message everywhere it travels.
+    if forwarded:
+        message = {**message, **FORWARDED_FIELDS}
+    else:
+        message = {**message, **ORIGINATED_FIELDS, "msg_id": next_msg_id()}
+
+    log_message(message=message, received=False)
 
-    message.update({
-        "msg_forwarder": STATE["port"],
-        "msg_id": STATE["msg_id"],
-    })
+    # Queue the message up; `flush_outbox` delivers it with the next batch
+    with OUTBOX_LOCK:
+        OUTBOX.setdefault(peer, []).append(message)
 
-    # If message originates from us, include that in the message
+
+def broadcast(peers: list, message: dict, forwarded: bool):
+    '''
+    Send the same message to each of `peers`.
+    '''
+    # A new message gets a single id for the whole fan-out, so the copies
+    # that reach a peer by different routes are recognised as duplicates
     if not forwarded:
-        message.update({"msg_originator": STATE["port"]})
+        message = {**message, **ORIGINATED_FIELDS, "msg_id": next_msg_id()}
 
-    log_message(message=message, received=False)
+    for peer in peers:
+        send_message_to(peer=peer, message=message, forwarded=True)
 
-    try:
-        req = requests.post("http://localhost:%d/receive" % peer, json=message)
-    except requests.exceptions.RequestException as e:
-        log_error(e)
-    except ConnectionResetError as e:
-        log_error(e)
 
-    STATE["msg_id"] += 1
+def next_msg_id() -> int:
+    msg_id = next(MSG_IDS)
+    STATE["msg_id"] = msg_id + 1
+    return msg_id
 
 #################################################################
 #################################################################
@@ -191,7 +276,38 @@ def receive():
     Parses the request and forwards it along to `respond`.
     You should not need to modify this function.
     '''
-    req_data = request.get_json()
+    handle_message(decode_json(request.get_data(cache=False)))
+    return "OK"
+
+
+@only_if_awake(STATE)
+@app.route("/receive_batch", methods=["POST"])
+def receive_batch():
+    '''
+    Entry-point for a batch of messages flushed from another node's outbox.
+    Each message is handled exactly as if it had arrived at `/receive`.
+    '''
+    for req_data in decode_json(request.get_data(cache=False))["batch"]:
+        # A malformed message only fails itself, not the rest of the batch
+        try:
+            handle_message(req_data)
+        except Exception as e:
+            log_error(e)
+    return "OK"
+
+
+def handle_message(req_data: dict):
+    '''
+    Parses a single message and forwards it along to `respond`. Messages
+    we've already seen are dropped up front, before any logging or parsing.
+    '''
+    key = (req_data["msg_id"], req_data["msg_originator"])
+    if key in RECEIVED_MESSAGES:
+        # Still counts as hearing from whoever passed it along
+        update_last_heard_from(int(req_data["msg_forwarder"]))
+        return
+    RECEIVED_MESSAGES.add(key)
+
     log_message(message=req_data, received=True)
 
     msg_type = req_data["msg_type"]
@@ -208,15 +324,20 @@ def receive():
     except Exception as e:
         log_error(e)
 
-    return "OK"
-
 
 def log_message(message: dict, received: bool):
-    logged = message.copy()
-    logged.update({"timestamp": time.time()})
+    # Store a reference, not a copy: messages are never changed once they've
+    # been logged, and only the few we display get turned into dicts
+    # (see `render_log_entry`)
+    LOGS.append((time.time(), received, message))
+
+
+def render_log_entry(entry: tuple) -> dict:
+    timestamp, received, message = entry
+    logged = {**message, "timestamp": timestamp}
     if received:
-        logged.update({"received": True})
-    LOGS.append(logged)
+        logged["received"] = True
+    return logged
 
 
 def log_error(e):
@@ -237,8 +358,45 @@ def send_pings_to_everyone():
         "data": None,
     }
 
-    for peer in [*STATE["peers"]]:
-        send_message_to(peer=peer, message=ping, forwarded=False)
+    broadcast(peers=peers_snapshot(), message=ping, forwarded=False)
+
+
+def flush_outbox():
+    '''
+    Routine that delivers everything queued up by `send_message_to`, one POST
+    per peer (split into chunks of at most MAX_BATCH_SIZE messages). Peers are
+    posted to in parallel so one slow peer doesn't hold up the rest.
+    Runs every 25 milliseconds.
+    '''
+    global OUTBOX
+    with OUTBOX_LOCK:
+        outbox, OUTBOX = OUTBOX, {}
+
+    for peer, messages in outbox.items():
+        for i in range(0, len(messages), MAX_BATCH_SIZE):
+            SEND_POOL.submit(post_batch, peer, messages[i:i + MAX_BATCH_SIZE])
+
+
+def post_batch(peer: int, messages: list):
+    url = URL_CACHE.get(peer)
+    if url is None:
+        url = URL_CACHE[peer] = "http://localhost:%d/receive_batch" % peer
+
+    try:
+        SESSION.post(
+            url,
+            data=encode_json({"batch": messages}),
+            headers={"Content-Type": "application/json"},
+            timeout=SEND_TIMEOUT,
+        )
+    except requests.exceptions.RequestException as e:
+        log_error(e)
+    except ConnectionResetError as e:
+        log_error(e)
+    except Exception as e:
+        # We run on SEND_POOL and nobody reads our future, so anything not
+        # logged here (e.g. a message that can't be encoded) vanishes silently
+        log_error(e)
 
 
 @only_if_awake(STATE)
@@ -247,10 +405,18 @@ def evict_stale_peers():
     Routine that evicts any peers who we haven't heard from in the last 10 seconds.
     Runs every second.
     '''
-    peers_to_remove = [p for p in [*STATE["peers"]] if is_stale(p)]
+    with PEERS_LOCK:
+        # Loop over a copy: a refresh racing with us may re-add a peer without the lock
+        peers_to_remove = [p for p in tuple(STATE["peers"]) if is_stale(p)]
 
-    for peer in peers_to_remove:
-        STATE["peers"].pop(peer)
+        for peer in peers_to_remove:
+            # Refreshes of known peers don't take PEERS_LOCK, so one may have
+            # landed since the scan; check again right before popping. That
+            # leaves only the few instructions between this check and the pop,
+            # where a refresh can still be lost (the peer then re-joins on its
+            # next message)
+            if is_stale(peer):
+                STATE["peers"].pop(peer)
 
 
 def is_stale(peer):
@@ -261,12 +427,36 @@ def is_stale(peer):
 @only_if_awake(STATE)
 def generate_and_gossip_next_mersenne_prime():
     '''
-    Routine that generates the next Mersenne prime and gossips it to our peers.
-    Runs every 10 seconds.
+    Routine that kicks off a search for the next Mersenne prime in the worker
+    process; `gossip_mersenne_prime` picks up the result once it's found.
+    Runs every 10 seconds, skipping a beat if the last search is still going.
     '''
-    new_prime = find_next_mersenne_prime(STATE["biggest_prime"])
-    STATE["biggest_prime"] = new_prime
-    STATE["biggest_prime_sender"] = MY_PORT
+    global PRIME_SEARCH
+    if PRIME_SEARCH is not None and not PRIME_SEARCH.done():
+        return
+
+    PRIME_SEARCH = PRIME_SEARCH_POOL.submit(find_next_mersenne_prime, STATE["biggest_prime"])
+    PRIME_SEARCH.add_done_callback(gossip_mersenne_prime)
+
+
+@only_if_awake(STATE)
+def gossip_mersenne_prime(search):
+    '''
+    Called when a prime search finishes; records the new prime and gossips it
+    to our peers, unless a peer has already told us about a bigger one.
+    '''
+    try:
+        new_prime = search.result()
+    except Exception as e:
+        log_error(e)
+        return
+
+    with STATE_LOCK:
+        if new_prime <= STATE["biggest_prime"]:
+            return
+
+        STATE["biggest_prime"] = new_prime
+        STATE["biggest_prime_sender"] = MY_PORT
 
     prime_message = {
         "msg_type": PRIME,
@@ -274,8 +464,7 @@ def generate_and_gossip_next_mersenne_prime():
         "data": new_prime,
     }
 
-    for peer in [*STATE["peers"]]:
-        send_message_to(peer=peer, message=prime_message, forwarded=False)
+    broadcast(peers=peers_snapshot(), message=prime_message, forwarded=False)
 
 
 @app.route("/message_log")
@@ -283,7 +472,17 @@ def message_log():
     '''
     Reads out the last 5 messages logged by this node.
     '''
-    return json.dumps(LOGS[-5:])
+    return OrjsonResponse(LAST_LOG_BYTES)
+
+
+def refresh_message_log():
+    '''
+    Routine that serializes the last 5 logged messages ahead of time, so
+    `/message_log` can hand out the same bytes however often it's polled.
+    Runs every 100 milliseconds.
+    '''
+    global LAST_LOG_BYTES
+    LAST_LOG_BYTES = encode_json([render_log_entry(entry) for entry in list(LOGS)[-5:]])
 
 
 @app.route("/reset", methods=["POST"])
@@ -292,17 +491,17 @@ def reset():
     Hard reset on all state for this node. Still gets initialized to having
     the same bootstrap peer it started with.
     '''
-    global LOGS, RECEIVED_MESSAGES, STATE
-    LOGS = []
-    RECEIVED_MESSAGES = set()
-    old_msg_id = STATE["msg_id"]
+    global LOGS, LAST_LOG_BYTES, RECEIVED_MESSAGES, STATE
+    LOGS = deque(maxlen=MAX_LOGS)
+    LAST_LOG_BYTES = b"[]"
+    RECEIVED_MESSAGES = BoundedSet(maxlen=MAX_RECEIVED_MESSAGES)
     STATE = {
         "name": MY_NAME,
         "port": MY_PORT,
         "peers": {},
         "biggest_prime": 2,
         "biggest_prime_sender": MY_PORT,
-        "msg_id": old_msg_id + 1,
+        "msg_id": next(MSG_IDS) + 1,
         "awake": True,
     }
     if len(sys.argv) >= 3:
@@ -327,7 +526,10 @@ def state():
     '''
     Reads out the current state of this node.
     '''
-    return STATE
+    # Serialize a copy of the peer list so it can't change size mid-encode
+    with PEERS_LOCK:
+        peers = dict(STATE["peers"])
+    return OrjsonResponse(encode_json({**STATE, "peers": peers}, option=orjson.OPT_NON_STR_KEYS))
 
 
 @app.route("/")
@@ -380,6 +582,12 @@ if __name__ == "__main__":
     if len(sys.argv) >= 3:
         STATE["peers"][int(sys.argv[2])] = time.time()
 
+    # Start the prime search worker while this is still the only thread: forking
+    # once waitress and the timers are running can leave the child deadlocked.
+    # The worker quits by itself if this node dies.
+    PRIME_SEARCH_POOL = ProcessPoolExecutor(max_workers=1, initializer=exit_with_parent)
+    PRIME_SEARCH_POOL.submit(int).result()
+
     # Send a ping to each of our peers once every 5 seconds
     ping_timer = Interval(5.0, send_pings_to_everyone)
 
@@ -389,9 +597,19 @@ if __name__ == "__main__":
     # Generate and gossip out a new Mersenne prime every 10 seconds
     prime_timer = Interval(10.0, generate_and_gossip_next_mersenne_prime)
 
+    # Flush queued outgoing messages to our peers every 25 milliseconds
+    flush_timer = Interval(0.025, flush_outbox)
+
+    # Re-serialize the tail of the message log for /message_log every 100 milliseconds
+    message_log_timer = Interval(0.1, refresh_message_log)
+
     ping_timer.start()
     eviction_timer.start()
     prime_timer.start()
+    flush_timer.start()
+    message_log_timer.start()
 
     logging.getLogger('waitress').setLevel(logging.ERROR)
-    serve(app, host="0.0.0.0", port=MY_PORT)
+    # Waitress only runs 4 handler threads by default; give peers, the dashboard
+    # and the proxy room to be served concurrently
+    serve(app, host="0.0.0.0", port=MY_PORT, threads=16)